@@ -20,6 +20,8 @@ from telegram.ext import (
     filters,
 )
 
+from tag_queue import TaggingQueue
+
 # --- Setup for Logging ---
 logging.basicConfig(
     format='%(asctime)s - %(name)s - %(levelname)s - %(message)s', level=logging.INFO
@@ -241,6 +243,11 @@ def get_fast_meaning_tags(text_to_analyze):
     else:
         return call_api_with_retry(text_to_analyze)
 
+# --- Tagging Work Queue ---
+QUEUE_STATS_INTERVAL = 300      # seconds between queue stats log lines
+
+tagging_queue = TaggingQueue(get_fast_meaning_tags)
+
 # --- Helper Functions (Unchanged) ---
 def parse_highlights(text):
     highlights = []
@@ -333,16 +340,16 @@ async def upload_highlights_start(update: Update, context: ContextTypes.DEFAULT_
     )
     return UPLOAD_HIGHLIGHTS
 
-async def process_uploaded_highlights(update: Update, context: ContextTypes.DEFAULT_TYPE) -> int:
-    chat_id_str = str(update.effective_chat.id)
+async def tag_uploaded_message(message, chat_id_str: str, context: ContextTypes.DEFAULT_TYPE) -> int:
+    """Parse and tag one uploaded file or text. Returns SELECT_TOPICS once new highlights are saved."""
     raw_text_document = ""
 
-    if update.message.document:
-        if not update.message.document.file_name.lower().endswith('.txt'):
-            await update.message.reply_text("Please upload a **.txt** file. Other file types are not supported for highlights.")
+    if message.document:
+        if not message.document.file_name.lower().endswith('.txt'):
+            await message.reply_text("Please upload a **.txt** file. Other file types are not supported for highlights.")
             return UPLOAD_HIGHLIGHTS
 
-        file_obj = await context.bot.get_file(update.message.document.file_id)
+        file_obj = await context.bot.get_file(message.document.file_id)
 
         try:
             file_buffer = io.BytesIO()
@@ -353,19 +360,19 @@ async def process_uploaded_highlights(update: Update, context: ContextTypes.DEFA
             logger.info(f"Successfully downloaded file. Content length: {len(raw_text_document)} characters")
         except Exception as e:
             logger.error(f"Error downloading or decoding file: {e}")
-            await update.message.reply_text("Sorry, I had trouble reading that file. Please make sure it's a plain text (.txt) file and try again.")
+            await message.reply_text("Sorry, I had trouble reading that file. Please make sure it's a plain text (.txt) file and try again.")
             return UPLOAD_HIGHLIGHTS
 
-    elif update.message.text:
-        raw_text_document = update.message.text
-        await update.message.reply_text("Thanks for the text! For larger collections, uploading a .txt file is recommended.")
+    elif message.text:
+        raw_text_document = message.text
+        await message.reply_text("Thanks for the text! For larger collections, uploading a .txt file is recommended.")
     else:
-        await update.message.reply_text("It seems you didn't send a .txt file or any text. Please try again.")
+        await message.reply_text("It seems you didn't send a .txt file or any text. Please try again.")
         return UPLOAD_HIGHLIGHTS
 
     parsed_highlights = parse_highlights(raw_text_document)
     if not parsed_highlights:
-        await update.message.reply_text("Could not find any clear highlights in your input. Please ensure your .txt file or text is clearly formatted.")
+        await message.reply_text("Could not find any clear highlights in your input. Please ensure your .txt file or text is clearly formatted.")
         return ConversationHandler.END
 
     if chat_id_str not in user_highlights:
@@ -376,47 +383,53 @@ async def process_uploaded_highlights(update: Update, context: ContextTypes.DEFA
     duplicate_count = len(parsed_highlights) - len(new_highlights)
 
     if duplicate_count > 0:
-        await update.message.reply_text(f"Found {len(parsed_highlights)} highlights. {duplicate_count} already exist and will be skipped. Processing {len(new_highlights)} new highlights...")
+        await message.reply_text(f"Found {len(parsed_highlights)} highlights. {duplicate_count} already exist and will be skipped. Processing {len(new_highlights)} new highlights...")
     else:
-        await update.message.reply_text(f"Found {len(new_highlights)} new highlights. Analyzing and categorizing them now...")
+        await message.reply_text(f"Found {len(new_highlights)} new highlights. Analyzing and categorizing them now...")
 
     if not new_highlights:
-        await update.message.reply_text("All highlights already exist in your collection. No new processing needed!")
+        await message.reply_text("All highlights already exist in your collection. No new processing needed!")
         return ConversationHandler.END
 
     batch_size = 10
     failed_highlights = []
     processed_count = 0
     existing_count = len(user_highlights[chat_id_str])
+    tag_futures = await tagging_queue.submit(chat_id_str, new_highlights)
 
-    for i, highlight_text in enumerate(new_highlights):
-        try:
-            if i > 0 and i % batch_size == 0:
-                progress_msg = f"Processing highlight {i}/{len(new_highlights)}... (Total in collection: {existing_count + processed_count})"
-                await update.message.reply_text(progress_msg, disable_notification=True)
-
-            tags = get_fast_meaning_tags(highlight_text)
-            if not tags or not isinstance(tags, list):
-                logger.warning(f"Invalid tags result for highlight {i+1}: {tags}")
-                tags = ["untagged"]
+    try:
+        for i, (highlight_text, tag_future) in enumerate(zip(new_highlights, tag_futures)):
+            if context.chat_data.get("cancel_upload"):
+                break
+            try:
+                if i > 0 and i % batch_size == 0:
+                    progress_msg = f"Processing highlight {i}/{len(new_highlights)}... (Total in collection: {existing_count + processed_count})"
+                    await message.reply_text(progress_msg, disable_notification=True)
 
-            user_highlights[chat_id_str][highlight_text] = tags
-            processed_count += 1
+                tags = await tag_future
+                if not tags or not isinstance(tags, list):
+                    logger.warning(f"Invalid tags result for highlight {i+1}: {tags}")
+                    tags = ["untagged"]
 
-            if processed_count % 25 == 0:
-                save_data_to_db()
-                logger.info(f"Saved progress: {processed_count}/{len(new_highlights)} new highlights processed")
+                user_highlights[chat_id_str][highlight_text] = tags
+                processed_count += 1
 
-            if i > 0 and i % 5 == 0:
-                await asyncio.sleep(0.5)
+                if processed_count % 25 == 0:
+                    save_data_to_db()
+                    logger.info(f"Saved progress: {processed_count}/{len(new_highlights)} new highlights processed")
 
-        except Exception as e:
-            logger.error(f"Error processing highlight {i+1}: {e}")
-            failed_highlights.append((i+1, highlight_text[:50] + "..."))
-            user_highlights[chat_id_str][highlight_text] = ["untagged", "processing-error"]
-            processed_count += 1
+            except Exception as e:
+                logger.error(f"Error processing highlight {i+1}: {e}")
+                failed_highlights.append((i+1, highlight_text[:50] + "..."))
+                user_highlights[chat_id_str][highlight_text] = ["untagged", "processing-error"]
+                processed_count += 1
+    finally:
+        # Stop tagging whatever is left if this upload is cancelled or bails out early.
+        tagging_queue.cancel(tag_futures)
 
     save_data_to_db()
+    if context.chat_data.get("cancel_upload"):
+        return ConversationHandler.END
 
     success_count = processed_count - len(failed_highlights)
     total_in_collection = len(user_highlights[chat_id_str])
@@ -428,12 +441,14 @@ async def process_uploaded_highlights(update: Update, context: ContextTypes.DEFA
     if duplicate_count > 0:
         result_message += f"🔄 Skipped {duplicate_count} duplicate highlights\n\n"
     result_message += f"📚 Total highlights in your collection: {total_in_collection}"
-    await update.message.reply_text(result_message)
+    await message.reply_text(result_message)
+    return SELECT_TOPICS
 
+async def send_topic_keyboard(message, chat_id_str: str) -> int:
     all_unique_tags = get_unique_tags(user_highlights[chat_id_str])
 
     if not all_unique_tags:
-        await update.message.reply_text(
+        await message.reply_text(
             "The smart service didn't find specific topics, but your highlights are saved. "
             "You can now use /wisdom to get a random nugget or /upload to add more."
         )
@@ -443,12 +458,52 @@ async def process_uploaded_highlights(update: Update, context: ContextTypes.DEFA
     keyboard.append([InlineKeyboardButton("Done Selecting Topics", callback_data="done_topics")])
     reply_markup = InlineKeyboardMarkup(keyboard)
 
-    await update.message.reply_text(
+    await message.reply_text(
         "Here are the topics found in your highlights. Select the ones you're interested in:",
         reply_markup=reply_markup,
     )
     return SELECT_TOPICS
 
+async def process_uploaded_highlights(update: Update, context: ContextTypes.DEFAULT_TYPE) -> int:
+    chat_id_str = str(update.effective_chat.id)
+    context.chat_data["cancel_upload"] = False
+    messages = [update.message]
+    next_state = UPLOAD_HIGHLIGHTS
+    tagged_any = False
+
+    # Files and text sent while this upload runs are kept by queue_upload_while_busy
+    # and processed here, in order, before the conversation moves on.
+    while messages:
+        for message in messages:
+            state = await tag_uploaded_message(message, chat_id_str, context)
+            if context.chat_data.get("cancel_upload"):
+                context.chat_data.pop("queued_uploads", None)
+                return ConversationHandler.END
+            if state == SELECT_TOPICS:
+                tagged_any = True
+            else:
+                next_state = state
+        if tagged_any:
+            next_state = await send_topic_keyboard(update.message, chat_id_str)
+            tagged_any = False
+        messages = context.chat_data.pop("queued_uploads", [])
+
+    if context.chat_data.get("cancel_upload"):
+        return ConversationHandler.END
+    return next_state
+
+async def queue_upload_while_busy(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
+    context.chat_data.setdefault("queued_uploads", []).append(update.message)
+    await update.message.reply_text("I'm still working on your previous upload. I'll add this one as soon as it's done.", disable_notification=True)
+
+async def upload_command_while_busy(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
+    await update.message.reply_text("I'm still working on your previous upload. You can send more files or text now and I'll add them when it's done, or use /cancel to stop.")
+
+async def cancel_running_upload(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
+    context.chat_data["cancel_upload"] = True
+    context.chat_data.pop("queued_uploads", None)
+    await update.message.reply_text("Operation cancelled. Highlights tagged so far have been saved.")
+
 async def select_topics(update: Update, context: ContextTypes.DEFAULT_TYPE) -> int:
     query = update.callback_query
     await query.answer()
@@ -525,6 +580,17 @@ async def topics_command_handler(update: Update, context: ContextTypes.DEFAULT_T
     await update.message.reply_text("Select or deselect topics:", reply_markup=reply_markup)
     return SELECT_TOPICS
 
+# --- Tagging Queue Monitoring ---
+async def log_tagging_queue_stats(context: ContextTypes.DEFAULT_TYPE) -> None:
+    for chat_id_str, stats in tagging_queue.get_stats().items():
+        if not stats["pending"] and not stats["in_flight"]:
+            continue
+        logger.info(
+            f"Tagging queue chat {chat_id_str}: pending {stats['pending']}, in flight {stats['in_flight']}, "
+            f"done {stats['jobs']}, avg wait {stats['avg_wait']:.2f}s, max wait {stats['max_wait']:.2f}s, "
+            f"avg service {stats['avg_service']:.2f}s"
+        )
+
 # --- Weekly Reminder Logic (Now async) ---
 async def check_and_send_weekly_reminders(context: ContextTypes.DEFAULT_TYPE) -> None:
     try:
@@ -616,12 +682,22 @@ async def main() -> None:
     application = Application.builder().token(TELEGRAM_BOT_TOKEN).build()
 
     # Conversation handler for uploading highlights
+    # Upload handlers are non-blocking so uploads from different chats run side by side
+    # and share the tagging queue instead of being processed one update at a time.
     upload_conv_handler = ConversationHandler(
         entry_points=[CommandHandler('upload', upload_highlights_start)],
         states={
-            UPLOAD_HIGHLIGHTS: [MessageHandler(filters.Document.TXT | (filters.TEXT & ~filters.COMMAND), process_uploaded_highlights)],
+            UPLOAD_HIGHLIGHTS: [MessageHandler(filters.Document.TXT | (filters.TEXT & ~filters.COMMAND), process_uploaded_highlights, block=False)],
             SELECT_TOPICS: [
-                MessageHandler(filters.Document.TXT | (filters.TEXT & ~filters.COMMAND), process_uploaded_highlights),
+                MessageHandler(filters.Document.TXT | (filters.TEXT & ~filters.COMMAND), process_uploaded_highlights, block=False),
+                CallbackQueryHandler(select_topics, pattern='^tag_.*$'),
+                CallbackQueryHandler(topics_done, pattern='^done_topics$')
+            ],
+            # While an upload is being processed, updates for this chat only reach these handlers.
+            ConversationHandler.WAITING: [
+                CommandHandler('cancel', cancel_running_upload),
+                CommandHandler('upload', upload_command_while_busy),
+                MessageHandler(filters.Document.TXT | (filters.TEXT & ~filters.COMMAND), queue_upload_while_busy),
                 CallbackQueryHandler(select_topics, pattern='^tag_.*$'),
                 CallbackQueryHandler(topics_done, pattern='^done_topics$')
             ],
@@ -655,6 +731,7 @@ async def main() -> None:
     # Schedule weekly reminder check
     job_queue = application.job_queue
     job_queue.run_repeating(check_and_send_weekly_reminders, interval=3600, first=0)
+    job_queue.run_repeating(log_tagging_queue_stats, interval=QUEUE_STATS_INTERVAL, first=QUEUE_STATS_INTERVAL)
 
     # Run the bot until the user presses Ctrl-C
     logger.info("Starting bot...")
@@ -0,0 +1,206 @@
+"""Fair scheduling of highlight tagging work across chats."""
+
+import asyncio
+import collections
+import logging
+import time
+
+logger = logging.getLogger(__name__)
+
+TAGGING_WORKERS = 4             # highlights tagged concurrently across all chats
+PER_CHAT_MAX_IN_FLIGHT = 2      # max highlights a bulk upload can have being tagged at once
+SMALL_UPLOAD_SIZE = 50          # chats with at most this many highlights queued or running count as interactive
+SMALL_UPLOAD_WEIGHT = 4.0       # share boost for interactive uploads (large uploads get 1.0)
+RECENT_STATS_SIZE = 100         # finished chats whose final queue stats are kept for get_recent_stats()
+
+class TaggingQueue:
+    """Central queue that shares tagging capacity fairly between chats.
+
+    Every highlight is one unit of work. Each chat gets a virtual finish tag per
+    item (start = max(virtual time, chat's last finish), finish = start + 1/weight)
+    and workers always pick the eligible item with the smallest finish tag, so a
+    huge upload cannot starve a small one that arrives later.
+
+    A chat's weight is set on every submit from its whole backlog (queued, running
+    and new items), so splitting a collection into many small uploads does not buy
+    interactive priority. Bulk chats never have more than per_chat_limit items
+    being tagged at the same time, while interactive chats may use every worker,
+    so their higher weight still wins slots when only a couple of chats compete.
+    """
+
+    def __init__(self, tag_func, workers=TAGGING_WORKERS, per_chat_limit=PER_CHAT_MAX_IN_FLIGHT,
+                 small_upload_size=SMALL_UPLOAD_SIZE, small_upload_weight=SMALL_UPLOAD_WEIGHT,
+                 recent_size=RECENT_STATS_SIZE):
+        self.tag_func = tag_func
+        self.workers = workers
+        self.per_chat_limit = per_chat_limit
+        self.small_upload_size = small_upload_size
+        self.small_upload_weight = small_upload_weight
+        self.recent_size = recent_size
+        self._pending = {}        # chat_id_str -> deque of (start, finish, text, future)
+        self._in_flight = {}      # chat_id_str -> number of items being tagged
+        self._weight = {}         # chat_id_str -> weight from the chat's backlog at its last submit
+        self._last_finish = {}    # chat_id_str -> finish tag of the chat's last queued item
+        self._ready_since = {}    # chat_id_str -> when the chat last had an item queued and a free slot
+        self._virtual_time = 0.0
+        self._stats = {}          # chat_id_str -> cumulative wait/service timings
+        self._recent = collections.OrderedDict()  # chat_id_str -> final stats of chats that went idle
+        self._cond = None
+        self._tasks = []
+
+    def _ensure_workers(self):
+        # Created lazily so the condition and tasks belong to the running event loop.
+        if self._cond is None:
+            self._cond = asyncio.Condition()
+        self._tasks = [t for t in self._tasks if not t.done()]
+        while len(self._tasks) < self.workers:
+            self._tasks.append(asyncio.ensure_future(self._worker()))
+
+    async def submit(self, chat_id_str, highlight_texts):
+        """Queue highlights for tagging. Returns one future (resolving to a tag list) per highlight."""
+        self._ensure_workers()
+        loop = asyncio.get_running_loop()
+        futures = []
+        async with self._cond:
+            queue = self._pending.setdefault(chat_id_str, collections.deque())
+            backlog = len(queue) + self._in_flight.get(chat_id_str, 0) + len(highlight_texts)
+            weight = self.small_upload_weight if backlog <= self.small_upload_size else 1.0
+            self._weight[chat_id_str] = weight
+            last_finish = self._last_finish.get(chat_id_str, 0.0)
+            for text in highlight_texts:
+                start = max(self._virtual_time, last_finish)
+                last_finish = start + 1.0 / weight
+                future = loop.create_future()
+                queue.append((start, last_finish, text, future))
+                futures.append(future)
+            self._last_finish[chat_id_str] = last_finish
+            self._refresh_ready(chat_id_str, time.monotonic())
+            self._cond.notify_all()
+        return futures
+
+    def cancel(self, futures):
+        """Give up on futures from submit(): queued items are skipped, finished errors are discarded."""
+        for future in futures:
+            if not future.done():
+                future.cancel()
+            elif not future.cancelled():
+                future.exception()  # mark as retrieved so asyncio doesn't log it
+
+    def _limit(self, chat_id_str):
+        return self.workers if self._weight[chat_id_str] > 1.0 else self.per_chat_limit
+
+    def _refresh_ready(self, chat_id_str, now):
+        # Wait is measured from when a chat could run its next item (queued and under its cap),
+        # so time spent behind the chat's own earlier items does not count against fairness.
+        queue = self._pending.get(chat_id_str)
+        if queue and self._in_flight.get(chat_id_str, 0) < self._limit(chat_id_str):
+            self._ready_since.setdefault(chat_id_str, now)
+        else:
+            self._ready_since.pop(chat_id_str, None)
+
+    def _next_job(self):
+        now = time.monotonic()
+        best_chat = None
+        for chat_id_str, queue in self._pending.items():
+            # Drop items whose uploader has gone away.
+            while queue and queue[0][3].cancelled():
+                queue.popleft()
+            if not queue:
+                self._ready_since.pop(chat_id_str, None)
+                continue
+            if self._in_flight.get(chat_id_str, 0) >= self._limit(chat_id_str):
+                continue
+            if best_chat is None or queue[0][1] < self._pending[best_chat][0][1]:
+                best_chat = chat_id_str
+        if best_chat is None:
+            return None
+
+        start, _, text, future = self._pending[best_chat].popleft()
+        self._virtual_time = max(self._virtual_time, start)
+        self._in_flight[best_chat] = self._in_flight.get(best_chat, 0) + 1
+        wait = now - self._ready_since.pop(best_chat, now)
+        self._refresh_ready(best_chat, now)
+        return best_chat, text, future, wait
+
+    def _forget_idle_chats(self):
+        # Once a chat has nothing queued or running, log its totals, keep them in the bounded
+        # recent-stats record and drop the rest of its state.
+        for chat_id_str in [c for c, q in self._pending.items() if not q]:
+            if not self._in_flight.get(chat_id_str):
+                stats = self.get_stats(chat_id_str)[chat_id_str]
+                if stats["jobs"]:
+                    logger.info(f"Tagging queue stats for chat {chat_id_str}: avg wait {stats['avg_wait']:.2f}s, "
+                                f"max wait {stats['max_wait']:.2f}s, avg service {stats['avg_service']:.2f}s over {stats['jobs']} highlights")
+                    stats["finished_at"] = time.time()
+                    self._recent.pop(chat_id_str, None)
+                    self._recent[chat_id_str] = stats
+                    while len(self._recent) > self.recent_size:
+                        self._recent.popitem(last=False)
+                del self._pending[chat_id_str]
+                self._in_flight.pop(chat_id_str, None)
+                self._weight.pop(chat_id_str, None)
+                self._last_finish.pop(chat_id_str, None)
+                self._ready_since.pop(chat_id_str, None)
+                self._stats.pop(chat_id_str, None)
+
+    def _record(self, chat_id_str, wait, service):
+        stats = self._stats.setdefault(chat_id_str, {"jobs": 0, "wait_total": 0.0, "wait_max": 0.0, "service_total": 0.0})
+        stats["jobs"] += 1
+        stats["wait_total"] += wait
+        stats["wait_max"] = max(stats["wait_max"], wait)
+        stats["service_total"] += service
+
+    async def _worker(self):
+        loop = asyncio.get_running_loop()
+        while True:
+            async with self._cond:
+                job = self._next_job()
+                while job is None:
+                    self._forget_idle_chats()
+                    await self._cond.wait()
+                    job = self._next_job()
+
+            chat_id_str, text, future, wait = job
+            started_at = time.monotonic()
+            try:
+                # Tagging may block on HTTP retries, so keep it off the event loop.
+                tags = await loop.run_in_executor(None, self.tag_func, text)
+            except Exception as e:
+                if not future.done():
+                    future.set_exception(e)
+            else:
+                if not future.done():
+                    future.set_result(tags)
+            finally:
+                finished_at = time.monotonic()
+                async with self._cond:
+                    self._in_flight[chat_id_str] -= 1
+                    self._record(chat_id_str, wait, finished_at - started_at)
+                    self._refresh_ready(chat_id_str, finished_at)
+                    self._forget_idle_chats()
+                    self._cond.notify_all()
+
+    def get_stats(self, chat_id_str=None):
+        """Wait and service times (seconds) and current backlog for chats with work queued or running.
+
+        Wait is how long a chat had an item queued and a free per-chat slot before a worker
+        picked it up, i.e. the delay caused by other chats rather than by its own backlog.
+        """
+        chat_ids = [chat_id_str] if chat_id_str is not None else sorted(self._pending)
+        result = {}
+        for chat in chat_ids:
+            stats = self._stats.get(chat, {"jobs": 0, "wait_total": 0.0, "wait_max": 0.0, "service_total": 0.0})
+            jobs = stats["jobs"]
+            result[chat] = {
+                "jobs": jobs,
+                "pending": len(self._pending.get(chat, ())),
+                "in_flight": self._in_flight.get(chat, 0),
+                "avg_wait": stats["wait_total"] / jobs if jobs else 0.0,
+                "max_wait": stats["wait_max"],
+                "avg_service": stats["service_total"] / jobs if jobs else 0.0,
+            }
+        return result
+
+    def get_recent_stats(self):
+        """Final stats of the most recent chats (up to recent_size) whose work has finished, oldest first."""
+        return {chat: dict(stats) for chat, stats in self._recent.items()}
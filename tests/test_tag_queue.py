@@ -0,0 +1,177 @@
+import asyncio
+import threading
+import time
+
+import pytest
+
+from tag_queue import TaggingQueue
+
+
+class StubTagger:
+    """Stands in for get_fast_meaning_tags: records dispatch order and per-chat concurrency."""
+
+    def __init__(self, delay=0.005):
+        self.delay = delay
+        self.order = []
+        self.running = {}
+        self.max_running = {}
+        self._lock = threading.Lock()
+
+    def __call__(self, text):
+        chat = text.split(":")[0]
+        with self._lock:
+            self.order.append(chat)
+            self.running[chat] = self.running.get(chat, 0) + 1
+            self.max_running[chat] = max(self.max_running.get(chat, 0), self.running[chat])
+        try:
+            time.sleep(self.delay)
+            if text.endswith("boom"):
+                raise ValueError(text)
+            return [text]
+        finally:
+            with self._lock:
+                self.running[chat] -= 1
+
+
+def texts(chat, count):
+    return [f"{chat}:{i}" for i in range(count)]
+
+
+def test_late_small_upload_is_interleaved_ahead_of_bulk_upload():
+    tagger = StubTagger()
+
+    async def run():
+        queue = TaggingQueue(tagger)
+        bulk = await queue.submit("A", texts("A", 200))
+        await asyncio.sleep(0.05)
+        small = await queue.submit("B", texts("B", 20))
+        await asyncio.gather(*small)
+        bulk_done = sum(f.done() for f in bulk)
+        await asyncio.gather(*bulk)
+        return bulk_done
+
+    bulk_done_when_small_finished = asyncio.run(run())
+
+    first_b = tagger.order.index("B")
+    last_b = len(tagger.order) - 1 - tagger.order[::-1].index("B")
+    # With weight 4 vs 1 the small upload should take roughly 4 of every 5 slots.
+    assert last_b - first_b < 20 * 1.5
+    assert bulk_done_when_small_finished < 100
+
+
+def test_bulk_uploads_respect_per_chat_in_flight_cap():
+    tagger = StubTagger()
+
+    async def run():
+        queue = TaggingQueue(tagger, workers=4, per_chat_limit=2, small_upload_size=10)
+        futures = []
+        for chat in ("A", "B", "C"):
+            futures += await queue.submit(chat, texts(chat, 40))
+        await asyncio.gather(*futures)
+        await asyncio.sleep(0.01)
+        return queue.get_stats(), queue.get_recent_stats()
+
+    active, recent = asyncio.run(run())
+
+    assert set(tagger.max_running) == {"A", "B", "C"}
+    assert all(peak <= 2 for peak in tagger.max_running.values())
+    assert active == {}
+    assert {chat: stats["jobs"] for chat, stats in recent.items()} == {"A": 40, "B": 40, "C": 40}
+
+
+def test_errors_reach_only_the_failing_future():
+    tagger = StubTagger()
+
+    async def run():
+        queue = TaggingQueue(tagger)
+        a = await queue.submit("A", ["A:0", "A:boom", "A:2"])
+        b = await queue.submit("B", ["B:0", "B:boom"])
+        return (await asyncio.gather(*a, return_exceptions=True),
+                await asyncio.gather(*b, return_exceptions=True))
+
+    a_results, b_results = asyncio.run(run())
+
+    assert a_results[0] == ["A:0"] and a_results[2] == ["A:2"]
+    assert isinstance(a_results[1], ValueError) and str(a_results[1]) == "A:boom"
+    assert b_results[0] == ["B:0"]
+    assert isinstance(b_results[1], ValueError) and str(b_results[1]) == "B:boom"
+
+
+def test_cancelled_upload_stops_using_workers():
+    tagger = StubTagger()
+
+    async def run():
+        queue = TaggingQueue(tagger)
+        futures = await queue.submit("A", texts("A", 100))
+        await asyncio.sleep(0.02)
+        queue.cancel(futures)
+        dispatched = len(tagger.order)
+        await asyncio.sleep(0.05)
+        return dispatched
+
+    dispatched_at_cancel = asyncio.run(run())
+
+    # Only items already handed to a worker may still run after cancelling.
+    assert len(tagger.order) <= dispatched_at_cancel + 2
+    assert len(tagger.order) < 100
+
+
+@pytest.mark.parametrize("count, expected_weight", [(50, 4.0), (51, 1.0)])
+def test_upload_size_sets_weight(count, expected_weight):
+    async def run():
+        queue = TaggingQueue(lambda text: [text], workers=1)
+        futures = await queue.submit("A", texts("A", count))
+        # submit() does not yield after queueing, so nothing has been dispatched yet.
+        weight = queue._weight["A"]
+        await asyncio.gather(*futures)
+        return weight
+
+    assert asyncio.run(run()) == expected_weight
+
+
+def test_splitting_a_bulk_upload_does_not_buy_interactive_priority():
+    tagger = StubTagger()
+
+    async def run():
+        queue = TaggingQueue(tagger, workers=4, per_chat_limit=2, small_upload_size=50)
+        futures = []
+        weights = []
+        for chunk in range(6):
+            futures += await queue.submit("A", [f"A:{chunk}-{i}" for i in range(20)])
+            weights.append(queue._weight["A"])
+        await asyncio.gather(*futures)
+        return weights
+
+    weights = asyncio.run(run())
+
+    # The backlog passes 50 on the third chunk, so the chat drops to bulk weight and cap.
+    assert weights == [4.0, 4.0, 1.0, 1.0, 1.0, 1.0]
+    assert tagger.max_running["A"] <= 2
+
+
+def test_wait_excludes_time_behind_own_backlog():
+    tagger = StubTagger()
+
+    async def run():
+        queue = TaggingQueue(tagger, workers=4, per_chat_limit=2)
+        await asyncio.gather(*await queue.submit("A", texts("A", 100)))
+        await asyncio.sleep(0.01)
+        return queue.get_recent_stats()["A"]
+
+    stats = asyncio.run(run())
+
+    # A lone chat always has a worker free, so it should see no scheduling wait even though
+    # its last items sat behind ~50 of its own items (~0.25s at 5ms each).
+    assert stats["jobs"] == 100
+    assert stats["max_wait"] < 0.05
+
+
+def test_recent_stats_are_bounded():
+    async def run():
+        queue = TaggingQueue(lambda text: [text], recent_size=2)
+        for chat in ("A", "B", "C"):
+            await asyncio.gather(*await queue.submit(chat, texts(chat, 3)))
+            await asyncio.sleep(0.01)
+        return queue.get_recent_stats()
+
+    assert list(asyncio.run(run())) == ["B", "C"]